@@ -1,10 +1,19 @@
+import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
-import asyncio
-from pyppeteer import launch
+import functools
+import hashlib
+import orjson
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import pytz
 import os
 import requests
+from plotly.offline import get_plotlyjs
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import plotly.io as pio
 
 
@@ -24,6 +33,46 @@ INTERVALS = {
     '1w': '604800',
 }
 
+# Tags used to recognize the buy/sell traces and annotations among the
+# rest of the figure
+_POINT_UIDS = ('buy_points', 'sell_points')
+_POINT_ANNOTATION = 'buy_sell_point'
+
+# Markers of the buy/sell point traces, built once and shared by
+# reference
+_BUY_MARKER = {
+    'color': '#bbdc86',
+    'line': {
+        'width': 1
+    },
+    'size': 7
+}
+_SELL_MARKER = {
+    'color': '#e70039',
+    'line': {
+        'width': 1
+    },
+    'size': 7
+}
+
+# Timezone used for all the dates of the charts
+_LOCAL = 'Europe/Madrid'
+_TZ = pytz.timezone(_LOCAL)
+
+# Session shared by all the API requests, it keeps the connection alive
+# so only the first chart pays the TLS handshake
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.2,
+        status_forcelist=(429, 500, 502, 503, 504)
+    )
+))
+
+
 class Chart:
     """
     Class that prints charts of ohlcv type with a specific date period
@@ -51,35 +100,41 @@ class Chart:
         If only the pair is given, the chart created is of the last day
         """
 
-        format = '%d/%m/%Y'
-        local = 'Europe/Madrid'
+        self.__setup_chart(pair, start, end, interval, None)
 
-        # By default, yesterday
-        start_date = (
-            pd.to_datetime(start, format=format).tz_localize(local)
-            if start else
-            pd.Timestamp.today(tz=local).floor('s') - pd.Timedelta('1d')
-        )
+    @classmethod
+    def _from_data(cls, pair, start, end, interval, data):
+        """
+        Creates a chart from already fetched candlestick and volume
+        data, skipping the request to the API. Used by build_charts to
+        overlap the downloads of several pairs.
 
-        # By default, today
-        end_date = (
-            pd.to_datetime(end, format=format).tz_localize(local)
-            if end else
-            pd.Timestamp.today(tz=local).floor('s')
-        )
+        :returns:  Chart
+        """
+
+        chart = cls.__new__(cls)
+        chart.__setup_chart(pair, start, end, interval, data)
+        return chart
+
+    def __setup_chart(self, pair, start, end, interval, data):
+        """
+        Common construction of the chart, the data is fetched from the
+        API unless it was already provided.
+        """
+
+        start_date, end_date = _get_date_range(start, end)
 
         # Change POSIX time from nanoseconds to seconds
         start_posix = start_date.value // (10 ** 9)
         end_posix = end_date.value // (10 ** 9)
 
-        data = _get_ohlcv_data(pair, interval, start_posix, end_posix)
+        if (data == None):
+            data = _get_ohlcv_data(pair, interval, start_posix, end_posix)
 
         # Create the folder where files will be saved
         folder_path = os.path.realpath('./archivos')
-        if (not os.path.isdir(folder_path)):
-            os.mkdir(folder_path)
-    
-        self.__local = local
+        os.makedirs(folder_path, exist_ok=True)
+
         self.__file_path = '{}/{}_{}_{}'.format(
             folder_path,
             pair,
@@ -89,6 +144,23 @@ class Chart:
         self.__pair = pair
         self.__start_date = start_date
         self.__end_date = end_date
+        self.__start_posix = start_posix
+        self.__end_posix = end_posix
+        self.__posix_range = end_posix - start_posix or 1
+
+        # Day-level bounds for the cheap buy/sell point discard
+        self.__start_day = int(start_date.strftime('%Y%m%d'))
+        self.__end_day = int(end_date.strftime('%Y%m%d'))
+
+        # Buy/sell points are collected here and flushed as one trace
+        # per color just before the chart is rendered
+        self.__buys = {'x': [], 'y': []}
+        self.__sells = {'x': [], 'y': []}
+        self.__annotations = []
+        self.__points_pending = False
+        self.__layout_set = False
+        self.__html_cache = None
+
         self.__fig = self.__create_figure(data)
 
     def get_pair(self):
@@ -132,15 +204,26 @@ class Chart:
 
         Points out of range are discarded
         """
-        point_date = pd.to_datetime(
-            date,
-            format='%d/%m/%Y %H:%M'
-        ).tz_localize(self.__local)
+        # Cheap day-level discard before parsing the timestamp, when
+        # replaying a portfolio most points fall outside the window.
+        # Day and month may come without the leading zero
+        day, month, rest = date.split('/', 2)
+        point_day = int(rest[:4] + month.zfill(2) + day.zfill(2))
+
+        if (point_day < self.__start_day or point_day > self.__end_day):
+            return
+
+        point_datetime = _parse_point_date(date)
+        point_posix = int(point_datetime.timestamp())
 
         # Check if point is in range
-        if (point_date < self.__start_date or point_date > self.__end_date):
+        if (point_posix < self.__start_posix or point_posix > self.__end_posix):
             return
 
+        # Plotly needs a Timestamp for the x value of the point, naive
+        # local time so it lines up with the chart axis
+        point_date = pd.Timestamp(point_datetime.replace(tzinfo=None))
+
         coin = self.__pair[:-3].upper()
         annotation = '{} {} {} at {} € <br> {}'.format(
             label.capitalize(),
@@ -150,56 +233,42 @@ class Chart:
             date
         )
         
-        point = {
-            'price': price, 
-            'date': point_date, 
-            'annotation': annotation
-        }
-
-        # Creates a scatter chart with just one point
-        color_point = (
-            '#bbdc86'
-            if label == 'b' or label == 'B' else
-            '#e70039'
+        # The point is only stored here, all of them are added to the
+        # chart in one go when it is rendered
+        points = (
+            self.__buys
+            if label[:1].lower() == 'b' else
+            self.__sells
         )
-        figure_point = go.Scatter(
-            x=[point['date']],
-            y=[point['price']],
-            mode='markers+text',
-            showlegend=False,
-            marker={
-                "color": color_point,
-                "line": {
-                    "width": 1
-                },
-                "size": 7
-            },
-        )
-
-        self.__fig.append_trace(figure_point, row=1, col=1)
-
-        pos = self.__get_note_position_x(point_date)
-        self.__fig.add_annotation(
-            x=point['date'],
-            y=point['price'],
-            text=point['annotation'],
-            showarrow=True,
-            font=dict(
+        points['x'].append(point_date)
+        points['y'].append(price)
+
+        pos = self.__get_note_position_x(point_posix)
+        self.__annotations.append({
+            'name': _POINT_ANNOTATION,
+            'x': point_date,
+            'y': price,
+            'text': annotation,
+            'showarrow': True,
+            'font': dict(
                 family="Courier New, monospace",
                 size=12,
                 color="#000000"
             ),
-            arrowhead=2,
-            arrowsize=1,
-            arrowwidth=2,
-            arrowcolor="#636363",
-            ax=pos,
-            bordercolor="#c7c7c7",
-            borderwidth=1,
-            borderpad=1,
-            bgcolor="#ff7f0e",
-            opacity=0.6,
-        )
+            'arrowhead': 2,
+            'arrowsize': 1,
+            'arrowwidth': 2,
+            'arrowcolor': "#636363",
+            'ax': pos,
+            'bordercolor': "#c7c7c7",
+            'borderwidth': 1,
+            'borderpad': 1,
+            'bgcolor': "#ff7f0e",
+            'opacity': 0.6,
+        })
+
+        self.__points_pending = True
+        self.__html_cache = None
 
     def delete_buy_sell_points(self):
         """
@@ -207,17 +276,24 @@ class Chart:
 
         The Plotly library doesn't have functionality to delete subparts of
         a chart nor annotations, this is why it is need to modify the 'fig'
-        object directly.
-        
-        This method has two assumptions:
-            1) The fig.data list has three elements and the last one
-               corresponds to the buy/sell points
-            2) The only annotations in 'fig' are the ones corresponding
-               to the buy/sell points
+        object directly. The point traces and annotations carry a tag,
+        so anything else added to the figure survives the deletion.
         """
 
-        self.__fig.data = [self.__fig.data[0], self.__fig.data[1]]
-        self.__fig.layout.annotations = []
+        self.__buys = {'x': [], 'y': []}
+        self.__sells = {'x': [], 'y': []}
+        self.__annotations = []
+        self.__points_pending = False
+        self.__html_cache = None
+
+        self.__fig.data = [
+            trace for trace in self.__fig.data
+            if trace.uid not in _POINT_UIDS
+        ]
+        self.__fig.layout.annotations = [
+            note for note in self.__fig.layout.annotations
+            if note.name != _POINT_ANNOTATION
+        ]
 
 
     def show_chart(self):
@@ -228,6 +304,7 @@ class Chart:
         # Select default browser (firefox, chrome, chromium, etc)
         pio.renderers.default = "browser"
 
+        self.__flush_points()
         self.__set_chart_layout()
         config = {'scrollZoom': True}
 
@@ -241,43 +318,80 @@ class Chart:
         :returns:  str  Returns the html file path
         """
 
-        self.__set_chart_layout()
-
-        config = dict({'scrollZoom': True})
-        
         html_path = "{}.html".format(self.__file_path)
-        self.__fig.write_html(html_path, config=config)
+
+        with open(html_path, 'w') as html_file:
+            html_file.write(self.__render_html())
+
+        # The plotly.js bundle is written once per folder instead of
+        # embedding its ~3 MB in every html file
+        bundle_path = os.path.join(os.path.dirname(html_path), 'plotly.min.js')
+        if (not os.path.isfile(bundle_path)):
+            with open(bundle_path, 'w') as bundle_file:
+                bundle_file.write(get_plotlyjs())
 
         return html_path
 
     def save_chart_as_png(self):
         """
-        This method converts the chart saved in the html file
-        to a png file. Since the pyppeteer library uses asynchronous
-        functions, I prefer to 'encapsulate' the function here so it
-        can be called like a normal method.
+        Saves the chart in a png file. The image is rendered by the
+        kaleido engine, which keeps a single Chromium process alive in
+        the background and reuses it for every export.
         """
 
-        asyncio.run(self.__save_image_async())
-        
+        self.__flush_points()
+        self.__set_chart_layout()
+
+        pio.write_image(
+            self.__fig,
+            '{}.png'.format(self.__file_path),
+            format='png',
+            width=1920,
+            height=1080
+        )
+
 
     # Private methods
-    def __get_note_position_x(self, point_date):
+    def __render_html(self):
+        """
+        Serializes the chart to its html document, reusing the cached
+        one when nothing changed since the last render. The document
+        references the plotly.js bundle of its folder.
+
+        :returns:  str  Returns the html document
+        """
+
+        if (self.__html_cache == None):
+            self.__flush_points()
+            self.__set_chart_layout()
+
+            config = {'scrollZoom': True}
+
+            # The figure is built by this class, re-validating it at
+            # serialization time is pure overhead
+            self.__html_cache = pio.to_html(
+                self.__fig,
+                config=config,
+                include_plotlyjs='directory',
+                full_html=True,
+                validate=False
+            )
+
+        return self.__html_cache
+
+    def __get_note_position_x(self, point_posix):
         """
         The annotation of the buy/sell points can be near the edgeds of the
         chart. This method adjusts the position in the X axe and displaces
         it to the center if it is too near the edge.
-        
-        :param point_date:  Date of the buy/sell point
-        :type point_date:   Datetime
-        :returns:           int       Returns the X position of the annotation
-        """
-        start_posix = self.__start_date.value // (10 ** 9)
-        end_posix = self.__end_date.value // (10 ** 9)
-        point_difference = end_posix - point_date.value // (10 ** 9)
-        difference = end_posix - start_posix
-        percentage = point_difference / difference
-        
+
+        :param point_posix:  Date of the buy/sell point (POSIX)
+        :type point_posix:   int
+        :returns:            int       Returns the X position of the annotation
+        """
+        point_difference = self.__end_posix - point_posix
+        percentage = point_difference / self.__posix_range
+
         if(percentage > 0.9):
             return 100
 
@@ -286,24 +400,53 @@ class Chart:
 
         return 20
 
-    async def __save_image_async(self):
+    def __flush_points(self):
         """
-        Launchs the chromium browser in the background and makes
-        a snapshot of the viewport.
+        Adds the collected buy/sell points to the chart, one scatter
+        trace per color instead of one trace per point. With hundreds
+        of points this keeps the figure small, since the render cost
+        grows with the number of traces.
         """
-        html_path = self.save_chart_as_html()
-        image_path = "{}.png".format(self.__file_path)
 
-        browser = await launch({'headless': True, 'defaultViewport': {'width': 1920, 'height': 1080}})
-        chart_page = await browser.newPage()
+        if (not self.__points_pending):
+            return
 
-        await chart_page.goto('file://{}'.format(html_path))
-        await chart_page.screenshot({
-            'path': '{}'.format(image_path),
-            'fullPage': 'true'
-        })
-        
-        await browser.close()
+        # Previously flushed traces are replaced instead of accumulated
+        self.__fig.data = [
+            trace for trace in self.__fig.data
+            if trace.uid not in _POINT_UIDS
+        ]
+
+        sides = (
+            (self.__buys, _BUY_MARKER, _POINT_UIDS[0]),
+            (self.__sells, _SELL_MARKER, _POINT_UIDS[1])
+        )
+        for points, marker, uid in sides:
+            if (not points['x']):
+                continue
+
+            # Scattergl renders through WebGL, which stays fast with
+            # thousands of markers. The x values stay as Timestamps,
+            # ns-precision datetime64 would serialize as raw integers
+            # and land the markers off the date axis
+            figure_points = go.Scattergl(
+                x=points['x'],
+                y=np.asarray(points['y'], dtype=np.float64),
+                mode='markers+text',
+                showlegend=False,
+                marker=marker,
+                uid=uid,
+            )
+
+            self.__fig.add_trace(figure_points, row=1, col=1)
+
+        # Annotations added outside the class are kept in place
+        other_notes = [
+            note for note in self.__fig.layout.annotations
+            if note.name != _POINT_ANNOTATION
+        ]
+        self.__fig.layout.annotations = other_notes + self.__annotations
+        self.__points_pending = False
 
     def __create_figure(self, data):
         """
@@ -314,23 +457,25 @@ class Chart:
         :type data:         Dictionary
         :returns:           Figure       Returns a Figure object from Plotly library
         """
-        extract_data = lambda x : [single_data[x] for single_data in data]
-
-        # Convert POSIX timestamps to local time
-        dates = pd.to_datetime(
-            extract_data(0),
-            unit='s',
-            utc=True
-        ).tz_convert(self.__local)
-
-        data_frame = pd.DataFrame({
-            'dates':           dates,
-            'open':   extract_data(1),
-            'close':     extract_data(4),
-            'maximum':     extract_data(2),
-            'minimum':     extract_data(3),
-            'volumes':        extract_data(5)
-        })
+        # One batched conversion of the JSON rows instead of one Python
+        # loop per column
+        array = np.asarray(data, dtype=np.float64)
+
+        # Convert POSIX timestamps to local time. Shifting the instants
+        # by the utc offset and keeping a naive datetime64 vector avoids
+        # the object-heavy tz-aware index, plotly serializes the values
+        # as they are
+        utc_offset = int(self.__start_date.utcoffset().total_seconds())
+        dates = (array[:, 0].astype('int64') + utc_offset).astype('datetime64[s]')
+
+        # The columns go straight into the traces, a DataFrame in the
+        # middle would copy each of them into a Series just to be read
+        # back once and discarded
+        open_prices = array[:, 1]
+        maximums = array[:, 2]
+        minimums = array[:, 3]
+        close_prices = array[:, 4]
+        volumes = array[:, 5]
 
         # Creates subplot (candlesticks/points and volume)
         fig = make_subplots(
@@ -343,36 +488,46 @@ class Chart:
 
         # Creates chart of candlesticks in the upper trace
         candlesticks = go.Candlestick(
-            x=data_frame['dates'],
-            open=data_frame['open'], 
-            high=data_frame['maximum'],
-            low=data_frame['minimum'], 
-            close=data_frame['close'],
+            x=dates,
+            open=open_prices,
+            high=maximums,
+            low=minimums,
+            close=close_prices,
             showlegend=False
         )
 
-        fig.append_trace(candlesticks, row=1, col=1)
+        fig.add_trace(candlesticks, row=1, col=1)
 
         # Volume chart in the lower trace
         volumen = go.Bar(
-            x=data_frame['dates'],
-            y=data_frame['volumes'],
+            x=dates,
+            y=volumes,
             showlegend=False,
             marker={
                 "color": "#EF553B",
             },
         )
 
-        fig.append_trace(volumen, row=2, col=1)
+        fig.add_trace(volumen, row=2, col=1)
 
         return fig
 
     def __set_chart_layout(self):
         """
-        Adds legends, range and other characteristics of the final chart
+        Adds legends, range and other characteristics of the final chart.
+        The layout never changes, so it is only applied the first time
+        the chart is rendered.
         """
+
+        if (self.__layout_set):
+            return
+
         delta = (self.__end_date - self.__start_date ) * 0.005
 
+        # The axis data is in naive local time, the range has to match
+        start_naive = self.__start_date.tz_localize(None)
+        end_naive = self.__end_date.tz_localize(None)
+
         title = '{}: {} - {}'.format(
             self.__pair,
             self.__start_date.strftime('%d-%m-%Y'),
@@ -385,7 +540,7 @@ class Chart:
             yaxis1_title = 'Price (€)',
             yaxis2_title = 'Volume',
             xaxis2_title = 'Time',
-            xaxis_range=[self.__start_date - delta, self.__end_date + delta],
+            xaxis_range=[start_naive - delta, end_naive + delta],
             title={
                 'text': title,
                 'y':0.94,
@@ -398,6 +553,107 @@ class Chart:
             )
         )
 
+        self.__layout_set = True
+
+
+def build_charts(pairs, start = '', end = '', interval = ''):
+    """
+    Creates the charts of several pairs at once, downloading the data
+    of all of them in parallel. requests releases the GIL while waiting
+    on the socket, so the downloads overlap instead of paying one round
+    trip after another.
+
+    :param pairs:        Symbols of the cripto-coin pairs '<crypto>eur'
+    :type pairs:         list
+    :param start:        Start date for the charts 'dd/mm/YYYY'
+    :type start:         str
+    :param end:          End date for the charts 'dd/mm/YYYY'
+    :type end:           str
+    :param interval:     Interval of the candlesticks
+    :type interval:      str
+    :returns:            List of Chart objects
+    """
+
+    start_date, end_date = _get_date_range(start, end)
+    start_posix = start_date.value // (10 ** 9)
+    end_posix = end_date.value // (10 ** 9)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        data_sets = list(executor.map(
+            lambda pair: _get_ohlcv_data(pair, interval, start_posix, end_posix),
+            pairs
+        ))
+
+    return [
+        Chart._from_data(pair, start, end, interval, data)
+        for pair, data in zip(pairs, data_sets)
+    ]
+
+
+def save_charts_as_png(charts):
+    """
+    Saves several charts as png files in one batch. All the exports
+    share the Chromium process that kaleido keeps alive, so only the
+    first one pays the engine startup.
+
+    :param charts:  Charts to save
+    :type charts:   list
+    :returns:       None
+    """
+
+    for chart in charts:
+        chart.save_chart_as_png()
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_point_date(date):
+    """
+    Parses the date of a buy/sell point and localizes it to the chart
+    timezone. strptime is much faster than the pandas string parser,
+    and repeated dates, common when replaying a portfolio, are cached.
+
+    :param date:   Date of the point 'dd/mm/YYYY HH:MM'
+    :type date:    str
+    :returns:      Localized datetime
+    """
+
+    return _TZ.localize(datetime.strptime(date, '%d/%m/%Y %H:%M'))
+
+
+def _get_date_range(start, end):
+    """
+    Converts the start and end dates of a chart to localized
+    timestamps, with their default values when empty.
+
+    :param start:   Start date 'dd/mm/YYYY', yesterday if empty
+    :type start:    str
+    :param end:     End date 'dd/mm/YYYY', today if empty
+    :type end:      str
+    :returns:       Tuple with the start and end Timestamps
+    """
+
+    format = '%d/%m/%Y'
+
+    # Timestamp.today with a timezone goes through the slow tz-aware
+    # construction path, datetime.now gives the same instant cheaper
+    now = pd.Timestamp(datetime.now(_TZ).replace(microsecond=0))
+
+    # By default, yesterday
+    start_date = (
+        pd.to_datetime(start, format=format).tz_localize(_LOCAL)
+        if start else
+        now - pd.Timedelta('1d')
+    )
+
+    # By default, today
+    end_date = (
+        pd.to_datetime(end, format=format).tz_localize(_LOCAL)
+        if end else
+        now
+    )
+
+    return start_date, end_date
+
 
 def _get_ohlcv_data(pair, interval, after, before):
     """
@@ -431,28 +687,198 @@ def _get_ohlcv_data(pair, interval, after, before):
     url_base_api = 'https://api.cryptowat.ch/markets'
     url_candlesticks = '{}/{}/{}/ohlc'.format(url_base_api, market, pair)
 
-    # The interval is not included in the request so all intervals
-    # of a time period are returned and the selected the optimal one
+    # Only one bucket is requested, the one the user fixed or the one
+    # guessed from the date span, which downloads a fraction of the
+    # bytes of the full response
+    periods = (
+        INTERVALS.get(interval, interval)
+        if (interval) else
+        _guess_interval(after, before)
+    )
+
+    data = _fetch_ohlcv_response(url_candlesticks, pair, periods, after, before)
+    optimal_interval = _get_optimal_interval(interval, data)
+
+    # The API doesn't serve every interval for old dates, if the
+    # guessed bucket came back empty fall back to the full response
+    if (optimal_interval == None and not interval):
+        data = _fetch_ohlcv_response(url_candlesticks, pair, None, after, before)
+        optimal_interval = _get_optimal_interval(interval, data)
+
+    if (optimal_interval == None):
+        raise Exception('The intervals in the response are empty!')
+
+    relevant_data = data['result']['{}'.format(optimal_interval)]
+    return relevant_data
+
+
+def _guess_interval(after, before):
+    """
+    Guesses the candlestick interval for a date span, the largest one
+    that still gives more points than the ideal chart size. It mirrors
+    the selection that _get_optimal_interval makes on a full response,
+    without having to download every bucket first.
+
+    :param after:       Date after which data is obtained (POSIX)
+    :type after:        Timestamp
+    :param before:      Date before which data is obtained (POSIX)
+    :type before:       Timestamp
+    :returns:           str    Interval duration in seconds
+    """
+
+    optimal_size = 500
+    span = before - after
+
+    # The INTERVALS values are in ascending order, so the last match is
+    # the largest valid interval
+    guess = None
+    for seconds in INTERVALS.values():
+        if (span / int(seconds) > optimal_size):
+            guess = seconds
+
+    return guess if guess != None else INTERVALS['1m']
+
+
+def _fetch_ohlcv_response(url, pair, periods, after, before):
+    """
+    Downloads one OHLCV response from the API, going through the disk
+    cache. The same slice is requested again and again while tuning a
+    chart, so it is only fetched once.
+
+    :param url:         Url of the ohlc endpoint for the pair
+    :type url:          str
+    :param periods:     Interval duration in seconds, None for all
+    :type periods:      str
+    :param after:       Date after which data is obtained (POSIX)
+    :type after:        Timestamp
+    :param before:      Date before which data is obtained (POSIX)
+    :type before:       Timestamp
+    :returns:           Content of the response
+    """
+
     query_string = {
         'before': before,
         'after': after
     }
 
+    if (periods != None):
+        query_string['periods'] = periods
+
+    data, etag, fresh = _read_cached_response(pair, periods or '', after, before)
+
+    if (fresh):
+        return data
+
+    # A stale entry can still be revalidated for free, the server
+    # answers 304 without a body when nothing changed
+    headers = {'Accept-Encoding': 'gzip'}
+    if (data != None and etag):
+        headers['If-None-Match'] = etag
+
     # Returns a Response object with the JSON data and if it fails, an
     # exception is thrown
-    response = requests.get(url_candlesticks, params=query_string)
+    response = _SESSION.get(
+        url,
+        params=query_string,
+        headers=headers,
+        timeout=(3.05, 10)
+    )
+
+    if (response.status_code == 304):
+        # Renew the entry lifetime, the content is still valid
+        os.utime(_get_cache_path(pair, periods or '', after, before))
+        return data
+
     response.raise_for_status()
 
-    # Extract relevant candlesticks and volumes data
-    data = response.json() # Has two properties, 'result' and 'allowance'
+    # Extract relevant candlesticks and volumes data, orjson parses
+    # the bytes directly and is several times faster than stdlib json
+    data = orjson.loads(response.content) # Has two properties, 'result' and 'allowance'
 
-    optimal_interval =  _get_optimal_interval(interval, data)
+    _write_cached_response(
+        pair, periods or '', after, before,
+        data,
+        response.headers.get('ETag')
+    )
 
-    if (optimal_interval == None):
-        raise Exception('The intervals in the response are empty!')
-    
-    relevant_data = data['result']['{}'.format(optimal_interval)]
-    return relevant_data
+    return data
+
+
+# Lifetime of a cached response whose slice reaches the present
+_CACHE_TTL = 60
+
+
+def _get_cache_path(pair, interval, after, before):
+    """
+    Builds the path of the cache file for a data slice.
+
+    :param pair:        Symbol of the crypto-coin pair '<crypto>eur'
+    :type pair:         str
+    :param interval:    Candlestick interval, empty for all of them
+    :type interval:     str
+    :param after:       Date after which data is obtained (POSIX)
+    :type after:        Timestamp
+    :param before:      Date before which data is obtained (POSIX)
+    :type before:       Timestamp
+    :returns:           str    Path of the cache file
+    """
+
+    key = hashlib.sha1('{}|{}|{}|{}'.format(pair, interval, after, before).encode()).hexdigest()
+    return os.path.join(os.path.realpath('./archivos'), '.cache', '{}.json'.format(key))
+
+
+def _read_cached_response(pair, interval, after, before):
+    """
+    Reads a previously cached API response from disk. Slices that end
+    in the past never change so they are valid forever, the slice that
+    reaches the present keeps growing and goes stale after a short
+    time, but its content and etag are still returned so the request
+    can be revalidated instead of downloaded again.
+
+    :returns:  Tuple with the content of the response or None if not
+               cached, its etag, and whether the entry is still fresh
+    """
+
+    cache_path = _get_cache_path(pair, interval, after, before)
+
+    try:
+        modified = os.stat(cache_path).st_mtime
+    except OSError:
+        return None, None, False
+
+    with open(cache_path, 'rb') as cache_file:
+        entry = orjson.loads(cache_file.read())
+
+    now = time.time()
+    fresh = not (before > now - _CACHE_TTL and now - modified > _CACHE_TTL)
+
+    # Entries written before etags were stored hold the bare response
+    if ('data' not in entry):
+        return entry, None, fresh
+
+    return entry['data'], entry['etag'], fresh
+
+
+def _write_cached_response(pair, interval, after, before, data, etag):
+    """
+    Writes an API response and its etag to the cache. The file is
+    written to a temporary name and renamed so readers never see a half
+    written cache entry.
+    """
+
+    cache_path = _get_cache_path(pair, interval, after, before)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+    entry = {
+        'etag': etag,
+        'data': data
+    }
+
+    temporal_path = '{}.tmp'.format(cache_path)
+    with open(temporal_path, 'wb') as cache_file:
+        cache_file.write(orjson.dumps(entry))
+
+    os.replace(temporal_path, cache_path)
 
 
 def _get_optimal_interval(time, data):
@@ -467,34 +893,40 @@ def _get_optimal_interval(time, data):
     :type data:    list           
     :returns:      int    Optinmal interval, if it doesn't exist, None
     """
-    # Interval defined by user
+    # Interval defined by user, the response is keyed by its
+    # duration in seconds
     if (time):
-        return time
+        return INTERVALS.get(time, time)
 
     optimal_size = 500
 
-    # Sort intervals by number of points
-    intervals = {}
-    for interval in data['result']:
-        size = len(data['result'][interval])
-        intervals[interval] = size
+    # Search the smallest interval which number of points is greater
+    # than the optimal size, keeping track of the largest one as
+    # fallback. One pass, no sorting needed
+    best_interval = None
+    best_size = None
+    largest_interval = None
+    largest_size = -1
+
+    for interval, points in data['result'].items():
+        size = len(points)
 
-    sorted_intervals = dict(sorted(intervals.items(), key=lambda x: x[1]))
+        if (size > optimal_size and (best_size == None or size < best_size)):
+            best_interval = interval
+            best_size = size
 
-    # Search the first interval which number of points is greater than the
-    # optimal size
-    for interval in sorted_intervals:
-        size = sorted_intervals[interval]
+        if (size > largest_size):
+            largest_interval = interval
+            largest_size = size
 
-        if optimal_size  < size:
-            return interval
+    if (best_interval != None):
+        return best_interval
 
-    # If not found, and the last one has no points, returns 0
-    interval, size = list(sorted_intervals.items())[-1]
-    if size == 0:
+    # If not found, and the largest one has no points, returns None
+    if (largest_size == 0):
         return None
 
-    return interval
+    return largest_interval
 
 
 if (__name__ == '__main__'):